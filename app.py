@@ -1,120 +1,280 @@
 # ── 標準 & 外部 ──────────────────────────────────────────
-import os, logging
-from datetime import datetime as dt, timezone
+import os, json, logging, threading
+from datetime import datetime as dt
+import click
 from dotenv import load_dotenv
 from flask import (
-    Flask, render_template, request, redirect, url_for,
-    send_from_directory, jsonify, abort
+    Flask, Blueprint, Response, render_template, request, url_for,
+    send_from_directory, send_file, jsonify, abort, current_app, stream_with_context
 )
-from apscheduler.schedulers.background import BackgroundScheduler
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import load_only
 
 # ── 自作モジュール（ここで必要関数を直接 import）───────────
-import email_sync_app
+from db import Session, get_engine
 from email_sync_app import (
-    Base, EmailModel,
+    EmailModel,
+    init_db,
+    render_body_html,
     fetch_past_month_and_save,
     fetch_and_save
 )
+import status_counts
+import archive
+import locks
 
-# ── MODEL（Note & Photo は元のまま）──────────────────────
-class NoteModel(Base):
-    __tablename__ = 'notes'
-    id          = Column(Integer, primary_key=True)
-    uidvalidity = Column(BigInteger, nullable=False)
-    uid         = Column(BigInteger, nullable=False)
-    page        = Column(Integer,  nullable=False)
-    content     = Column(Text,     default='')
-    uploaded_at = Column(DateTime, default=lambda: dt.now(timezone.utc))
-
-class PhotoModel(Base):
-    __tablename__ = 'photos'
-    id          = Column(Integer, primary_key=True)
-    uidvalidity = Column(BigInteger, nullable=False)
-    uid         = Column(BigInteger, nullable=False)
-    filename    = Column(String(255), nullable=False)
-    uploaded_at = Column(DateTime, default=lambda: dt.now(timezone.utc))
-
-# ── Flask / DB ─────────────────────────────────────────
-load_dotenv()
-DB_URL  = os.getenv('DATABASE_URL', 'sqlite:///emails.db')
-SECRET  = os.getenv('FLASK_SECRET_KEY', 'dev')
+# ── 設定値 ─────────────────────────────────────────
 UPLOAD  = os.path.join(os.path.dirname(__file__), 'uploads')
-os.makedirs(UPLOAD, exist_ok=True)
-
-app = Flask(__name__)
-app.config.update(SECRET_KEY=SECRET, UPLOAD_FOLDER=UPLOAD)
 
-engine  = create_engine(DB_URL, echo=False, future=True)
-Session = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
+SYNC_LOCK = 'imap_sync'   # IMAP 同期は全プロセス（web / スケジューラ / CLI）で同時に 1 本まで
+log = logging.getLogger(__name__)
 
 # ── メール同期ラッパ ────────────────────────────────
 def sync_last_month():
-    app.logger.info("▶ Initial 30-day fetch")
-    fetch_past_month_and_save()
+    with locks.hold(SYNC_LOCK) as got:
+        if not got:
+            log.info("Sync already running, skip 30-day fetch")
+            return False
+        log.info("▶ 30-day backfill")
+        fetch_past_month_and_save()
+        return True
 
 def sync_latest(limit=50):
-    app.logger.info("▶ Periodic fetch")
-    fetch_and_save(limit=limit)
+    """差分取得。他の同期が走っていれば待たずに False を返す"""
+    with locks.hold(SYNC_LOCK) as got:
+        if not got:
+            log.info("Sync already running, skip periodic fetch")
+            return False
+        log.info("▶ Periodic fetch")
+        fetch_and_save(limit=limit)
+        return True
 
 # ── APScheduler ───────────────────────────────────────
-def start_scheduler():
-    sched = BackgroundScheduler(timezone="Asia/Tokyo")
-    # プロセス起動直後に 1 回だけ
-    sched.add_job(sync_last_month,
-                  id='initial_once',
-                  next_run_time=dt.now(timezone.utc),
-                  max_instances=1)
-    # 15 分おきに差分取得
+def build_scheduler(blocking=False):
+    """定期ジョブを登録したスケジューラを返す（start はしない）"""
+    if blocking:
+        from apscheduler.schedulers.blocking import BlockingScheduler as Scheduler
+    else:
+        from apscheduler.schedulers.background import BackgroundScheduler as Scheduler
+    sched = Scheduler(timezone="Asia/Tokyo")
+    # 15 分おきに差分取得（過去分の取り込みは `flask backfill` で明示的に）
     sched.add_job(sync_latest,
                   'interval', minutes=15,
-                  id='loop', kwargs={'limit': 50})
-    sched.start()
-    app.logger.info("Scheduler started")
+                  id='loop', kwargs={'limit': 50},
+                  max_instances=1)
+    # 毎晩カウンタを emails から作り直してずれを解消
+    sched.add_job(reconcile_counts,
+                  'cron', hour=3, minute=0,
+                  id='reconcile_counts', max_instances=1)
+    # 毎晩、対応済みの古いメールをアーカイブへ移す
+    sched.add_job(archive_old_emails,
+                  'cron', hour=3, minute=30,
+                  id='archive_old', max_instances=1)
+    return sched
+
+def reconcile_counts():
+    with locks.hold('reconcile_counts') as got:
+        if not got:
+            log.info("Reconcile already running, skip")
+            return
+        sess = Session()
+        try:
+            n = status_counts.reconcile(sess)
+            log.info("Status counts reconciled (%d rows)", n)
+        finally:
+            sess.close()
+
+def archive_old_emails(days=None):
+    with locks.hold('archive') as got:
+        if not got:
+            log.info("Archive already running, skip")
+            return 0
+        sess = Session()
+        try:
+            n = archive.archive_old(sess, days=days)
+            log.info("Archived %d emails", n)
+            return n
+        finally:
+            sess.close()
+
+# ── アプリ生成 ─────────────────────────────────────────
+bp = Blueprint('main', __name__)
+
+
+def create_app():
+    """Flask アプリを組み立てて返す。
+
+    import しただけでは DB にも IMAP にも触らない。起動時の処理は明示的に:
+      flask --app app init-db     テーブル作成・カラム追加（Procfile の release）
+      flask --app app scheduler   定期同期を動かす常駐プロセス（Procfile の worker）
+      flask --app app backfill    過去 30 日分を一度だけ取り込む
+    ここではスケジューラを起動しない（gunicorn の worker ごと・CLI ごとに動いてしまうため）。
+    worker dyno を使わない 1 dyno 運用では RUN_SCHEDULER=1 にすると、
+    gunicorn の master が 1 つだけ起動する（gunicorn.conf.py の when_ready）。
+    """
+    load_dotenv()
+    os.makedirs(UPLOAD, exist_ok=True)
+    get_engine()   # プロセス共通のエンジンを生成（接続は最初のクエリ時）
+
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY=os.getenv('FLASK_SECRET_KEY', 'dev'),
+        UPLOAD_FOLDER=UPLOAD,
+        # 外向き I/O の上限（値は worker プロセスごと。gunicorn.conf.py も参照）
+        PROXY_MAX_CONCURRENCY=int(os.getenv('PROXY_MAX_CONCURRENCY', '4')),     # /proxy の同時取得数
+        PROXY_QUEUE_WAIT=float(os.getenv('PROXY_QUEUE_WAIT', '2')),             # 空き待ち秒 → 超えたら 503
+        PROXY_TIMEOUT=(float(os.getenv('PROXY_CONNECT_TIMEOUT', '3')),          # (接続, 読み取り) 秒
+                       float(os.getenv('PROXY_READ_TIMEOUT', '5'))),
+    )
+    app.extensions['proxy_slots'] = threading.BoundedSemaphore(app.config['PROXY_MAX_CONCURRENCY'])
+
+    app.register_blueprint(bp)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(scheduler_command)
+    app.cli.add_command(backfill_command)
+    app.cli.add_command(reconcile_counts_command)
+    app.cli.add_command(archive_command)
+    return app
+
+# ── CLI（起動時の処理はここから明示的に呼ぶ）───────────
+@click.command('init-db')
+def init_db_command():
+    """テーブルを作成し、足りないカラムを追加する"""
+    init_db()
+    click.echo('DB initialized')
+
+@click.command('scheduler')
+def scheduler_command():
+    """定期同期のスケジューラをフォアグラウンドで動かす"""
+    if os.getenv('RUN_SCHEDULER') == '1':
+        raise click.ClickException('RUN_SCHEDULER=1 では web（gunicorn master）がスケジューラを動かします')
+    logging.basicConfig(level=logging.INFO)
+    build_scheduler(blocking=True).start()
+
+@click.command('backfill')
+def backfill_command():
+    """過去 30 日分のメールを取り込む"""
+    logging.basicConfig(level=logging.INFO)
+    sync_last_month()
+
+@click.command('reconcile-counts')
+def reconcile_counts_command():
+    """ステータス別件数カウンタを emails から作り直す"""
+    reconcile_counts()
+    click.echo('Status counts reconciled')
 
-start_scheduler()
+@click.command('archive')
+@click.option('--days', type=int, default=None,
+              help='この日数より古いものを移す（既定: ARCHIVE_AFTER_DAYS）')
+def archive_command(days):
+    """対応済みの古いメールを emails_archive へ移す"""
+    n = archive_old_emails(days)
+    click.echo(f'Archived {n} emails')
 
 # ── ルーティング（一覧だけ例示、他は元のまま残して下さい）───
-@app.route('/')
+@bp.route('/')
 def index():
     sess = Session()
-    emails = sess.query(EmailModel).order_by(EmailModel.date.desc()).all()
+    # 一覧に要る列だけ読む（本文・raw_content は詳細表示時に）
+    emails = (sess.query(EmailModel)
+                  .options(load_only(EmailModel.uidvalidity, EmailModel.uid, EmailModel.subject,
+                                     EmailModel.customer_name, EmailModel.status, EmailModel.date))
+                  .order_by(EmailModel.date.desc())
+                  .all())
     sess.close()
     return render_template('emails.html', emails=emails)
 
 # ▼ 追加：今すぐ取り込むボタン用 API ───────────────────
-@app.route('/sync_now', methods=['POST'])
+@bp.route('/sync_now', methods=['POST'])
 def sync_now():
     try:
-        sync_latest(limit=10)      # ← ここを 10 に変更
+        if not sync_latest(limit=10):      # ← ここを 10 に変更
+            return jsonify({'ok': False, 'error': '同期中です。しばらくしてから再実行してください'}), 409
         return jsonify({'ok': True}), 200
     except Exception as e:
-        app.logger.exception("Manual sync failed")
+        current_app.logger.exception("Manual sync failed")
         return jsonify({'ok': False, 'error': str(e)}), 500
 # ▲ ここまで追加 ──────────────────────────────────
-# --- いま DB に入っているメール件数を返すだけの簡易 API ---
-@app.route('/count')
+# --- いま DB に入っているメール件数を返すだけの簡易 API（カウンタ表から）---
+@bp.route('/count')
 def count_mails():
     sess = Session()
-    n = sess.query(EmailModel).count()
+    n = sum(status_counts.totals(sess).values())
     sess.close()
     return {'count': n}
 
+# --- ステータス別件数（サイドバーのバッジ用）。?days=N で日別内訳も返す ---
+@bp.route('/counts')
+def counts():
+    sess = Session()
+    by_status = status_counts.totals(sess)
+    data = {'total': sum(by_status.values()), 'by_status': by_status}
+    days = request.args.get('days', type=int)
+    if days and days > 0:
+        data['by_day'] = status_counts.by_day(sess, min(days, 366))
+    sess.close()
+    return jsonify(data)
+
+# --- ステータス変更（カウンタも同じトランザクションで付け替え）---
+@bp.route('/emails/<int:uv>/<int:uid>/update_status', methods=['POST'])
+def update_status(uv, uid):
+    new = (request.form.get('status') or '').strip()
+    if new not in status_counts.STATUSES:
+        abort(400, 'invalid status')
+
+    sess = Session()
+    try:
+        m = sess.get(EmailModel, (uv, uid))
+        if m is None:
+            a = sess.get(archive.ArchivedEmailModel, (uv, uid))
+            if a is None:
+                abort(404)
+            if a.status == new:
+                return jsonify({'ok': True, 'status': new})
+            # アーカイブ中のメールは、対応中のステータスに戻すときだけ emails へ戻して変更する
+            if new in archive.archive_settings()[1]:
+                abort(409, 'アーカイブ済みのメールです')
+            m = archive.restore(sess, a)
+        old = m.status
+        if old != new:
+            # 読んだときの status のままなら書き換える。同時に変更されていたら 0 行になるので
+            # カウンタは動かさずに 409（両方が同じ old を減らしてずれるのを防ぐ）
+            try:
+                changed = sess.execute(update(EmailModel)
+                                       .where(EmailModel.uidvalidity == uv, EmailModel.uid == uid,
+                                              EmailModel.status == old)
+                                       .values(status=new)).rowcount
+            except IntegrityError:      # 同じアーカイブ行を別のリクエストが先に戻した
+                changed = 0
+            if changed != 1:
+                sess.rollback()
+                abort(409, '他の操作でステータスが変更されました')
+            day = status_counts.day_of(m)
+            status_counts.bump(sess, old, day, -1)
+            status_counts.bump(sess, new, day, +1)
+            sess.commit()
+    finally:
+        sess.close()
+    return jsonify({'ok': True, 'status': new})
+
 # ── 画像配信など既存エンドポイントは元のまま ────────────
-@app.route('/uploads/<path:filename>')
+@bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     return send_from_directory(UPLOAD, filename)
 
-from sqlalchemy.inspection import inspect
-
-@app.route('/email/<int:uv>/<int:uid>')
+@bp.route('/email/<int:uv>/<int:uid>')
 def email_detail(uv, uid):
     sess = Session()
     m = (sess.query(EmailModel)
               .filter_by(uidvalidity=uv, uid=uid)
               .first())
+    archived = False
+    if not m:
+        # hot 側に無ければアーカイブから復元
+        m = archive.load(sess, uv, uid)
+        archived = m is not None
     if not m:
         sess.close()
         abort(404)
@@ -125,6 +285,13 @@ def email_detail(uv, uid):
     # introspect で存在するカラム名一覧を取得
     cols = {c.key for c in inspect(m).mapper.column_attrs}
 
+    # 取り込み時に整形済みならそのまま、古い行だけここで整形
+    if m.body_html is not None:
+        body_html  = m.body_html
+        image_urls = json.loads(m.image_urls or '[]')
+    else:
+        body_html, image_urls = render_body_html(m.body)
+
     data = {
         'uidvalidity': m.uidvalidity,
         'uid'        : m.uid,
@@ -133,30 +300,101 @@ def email_detail(uv, uid):
         'from_addr'  : get('from_addr') or get('sender', ''),
         'date'       : get('date').isoformat() if 'date' in cols and m.date else '',
         'body'       : get('body'),
+        'body_html'  : body_html,
+        'image_urls' : image_urls,
         'status'     : get('status'),
+        'archived'   : archived,
         # notes / photos は存在すれば展開、無ければ空
         'notes' : {n.page: n.content for n in getattr(m, 'notes', [])},
-        'photos': [url_for('uploaded_file', filename=p.filename)
+        'photos': [url_for('.uploaded_file', filename=p.filename)
                    for p in getattr(m, 'photos', [])]
     }
     sess.close()
     return jsonify(data)
 
-# --- リモート画像を同一オリジンから配信する簡易プロキシ -----------------
-import requests
-from flask import Response  # 既に import していなければ追加
+# --- 件名・差出人・本文で検索。archived=1 でアーカイブ（件名・差出人のみ）も対象 ---
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify([])
+    limit = 100
+    like  = f'%{q}%'
 
-@app.route('/proxy')
+    sess = Session()
+    rows = (sess.query(EmailModel.uidvalidity, EmailModel.uid, EmailModel.subject,
+                       EmailModel.from_addr, EmailModel.date, EmailModel.status)
+                .filter(or_(EmailModel.subject.ilike(like),
+                            EmailModel.from_addr.ilike(like),
+                            EmailModel.body.ilike(like)))
+                .order_by(EmailModel.date.desc())
+                .limit(limit)
+                .all())
+    hits = [dict(r._mapping, archived=False) for r in rows]
+    if request.args.get('archived') == '1':
+        hits += [dict(r._mapping, archived=True) for r in archive.search(sess, q, limit)]
+    sess.close()
+
+    for h in hits:
+        h['date'] = h['date'].isoformat() if h['date'] else ''
+    return jsonify(hits)
+
+# --- 見積もりデータの CSV / XLSX エクスポート（行は少しずつ読み書きする）---
+@bp.route('/export')
+def export_quotes():
+    import export   # mail_processor を読み込むので使うときだけ
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'xlsx'):
+        abort(400, 'format は csv / xlsx')
+    try:
+        since = export.parse_date(request.args.get('since'))
+        until = export.parse_date(request.args.get('until'))
+    except ValueError:
+        abort(400, 'since / until は YYYY-MM-DD')
+    statuses = request.args.getlist('status') or None
+    include_archived = request.args.get('archived', '1') != '0'
+    stamp    = dt.now().strftime('%Y%m%d')
+
+    if fmt == 'xlsx':
+        sess = Session()
+        try:
+            tmp = export.xlsx_tempfile(export.iter_db_rows(sess, since, until, statuses, include_archived))
+        finally:
+            sess.close()
+        return send_file(tmp, as_attachment=True, download_name=f'quotes_{stamp}.xlsx',
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    def generate():
+        sess = Session()
+        try:
+            yield from export.iter_csv(export.iter_db_rows(sess, since, until, statuses, include_archived))
+        finally:
+            sess.close()
+
+    return Response(stream_with_context(generate()), content_type='text/csv; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename=quotes_{stamp}.csv'})
+
+# --- リモート画像を同一オリジンから配信する簡易プロキシ -----------------
+@bp.route('/proxy')
 def proxy():
     url = request.args.get('url', '')
     # 最低限のバリデーション
     if not url.startswith(('http://', 'https://')):
         abort(400, 'invalid url')
 
+    import requests   # 重いので初回リクエスト時に読み込む
+
+    # 同時取得数を絞り、遅い外部サーバで worker のスレッドを食い潰さない
+    slots = current_app.extensions['proxy_slots']
+    if not slots.acquire(timeout=current_app.config['PROXY_QUEUE_WAIT']):
+        abort(503, 'proxy busy')
     try:
-        r = requests.get(url, timeout=10)
+        r = requests.get(url, timeout=current_app.config['PROXY_TIMEOUT'])
     except requests.exceptions.RequestException:
         abort(502, 'fetch error')
+    finally:
+        slots.release()
 
     # Content-Type をそのまま転送
     return Response(
@@ -168,4 +406,7 @@ def proxy():
 
 
 if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+古いメールのアーカイブ（hot / cold 分割）。
+
+対応が終わった（ARCHIVE_STATUSES の）メールのうち ARCHIVE_AFTER_DAYS 日より古いものを
+emails から emails_archive へ移す。本文などの大きい列は zlib 圧縮した 1 つの payload に、
+受信したままのメール（raw_bytes）は別の列に zlib 圧縮してまとめ、
+一覧・検索に使う列（件名・差出人・日付・ステータス）だけ素のまま残す。
+
+  - raw_bytes がある行は raw_content を持たない（raw_bytes から作り直せるため）
+  - body_html / image_urls は持たず、復元時に body から render_body_html で作る
+
+  - notes / photos は (uidvalidity, uid) で紐づいているだけなので触らない（そのまま残る）
+  - 詳細 API は emails に無ければここから復元して返す
+  - アーカイブ対象外のステータスに戻されたメールは restore() で emails へ戻す
+  - 件数カウンタ（status_counts）はアーカイブ分も含めて数える
+
+環境変数と既定値 ──────────────────────────
+  ARCHIVE_AFTER_DAYS  180
+  ARCHIVE_STATUSES    荷物返送済み         （カンマ区切りで複数可）
+"""
+
+import os
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import (
+    Column, BigInteger, String, Text, DateTime, LargeBinary,
+    UniqueConstraint, delete, or_, tuple_
+)
+
+from db import Base
+from email_sync_app import EmailModel, render_body_html
+
+ARCHIVE_BATCH = 200
+
+# payload に圧縮して入れる列
+_PACKED = ('to_addr', 'body', 'fields', 'customer_name', 'raw_content', 'gpt_response')
+
+
+class ArchivedEmailModel(Base):
+    __tablename__ = 'emails_archive'
+
+    uidvalidity = Column(BigInteger, primary_key=True)
+    uid         = Column(BigInteger, primary_key=True)
+    message_id  = Column(String(255), nullable=False)
+
+    subject     = Column(Text)
+    from_addr   = Column(Text)
+    date        = Column(DateTime)
+    status      = Column(String(20))
+    fetched_at  = Column(DateTime)
+    archived_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    payload     = Column(LargeBinary)     # zlib(JSON): _PACKED の各列
+    raw_bytes   = Column(LargeBinary)     # zlib(受信したままの RFC822)
+
+    __table_args__ = (
+        UniqueConstraint('message_id', name='_archive_message_id_uc'),
+    )
+
+
+def archive_settings() -> tuple[int, list[str]]:
+    days     = int(os.getenv('ARCHIVE_AFTER_DAYS', '180'))
+    statuses = [s.strip() for s in os.getenv('ARCHIVE_STATUSES', '荷物返送済み').split(',') if s.strip()]
+    return days, statuses
+
+
+def pack_payload(data: dict) -> bytes:
+    """_PACKED の各列の dict を payload にする"""
+    data = {k: data.get(k) for k in _PACKED}
+    return zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+
+def unpack_payload(payload: bytes | None) -> dict:
+    """payload を _PACKED の各列の dict に戻す"""
+    return json.loads(zlib.decompress(payload).decode('utf-8')) if payload else {}
+
+
+def _pack(m: EmailModel) -> tuple[bytes, bytes | None]:
+    """(payload, 圧縮した raw_bytes) を返す"""
+    data = {k: getattr(m, k) for k in _PACKED}
+    if m.raw_bytes is not None:
+        data['raw_content'] = None
+    return pack_payload(data), zlib.compress(m.raw_bytes) if m.raw_bytes is not None else None
+
+
+def unpack_raw(raw_bytes: bytes | None) -> bytes | None:
+    return zlib.decompress(raw_bytes) if raw_bytes is not None else None
+
+
+def _unpack(a: ArchivedEmailModel) -> EmailModel:
+    """アーカイブ行を（セッションに属さない）EmailModel に戻す"""
+    data = unpack_payload(a.payload)
+    raw  = unpack_raw(a.raw_bytes)
+    if raw is not None:
+        data['raw_content'] = raw.decode('utf-8', 'ignore')     # 取り込み時と同じ形に
+    body_html, image_urls = render_body_html(data.get('body'))
+    return EmailModel(uidvalidity=a.uidvalidity, uid=a.uid, message_id=a.message_id,
+                      subject=a.subject, from_addr=a.from_addr, date=a.date,
+                      status=a.status, fetched_at=a.fetched_at,
+                      body_html=body_html, image_urls=json.dumps(image_urls, ensure_ascii=False),
+                      raw_bytes=raw, **{k: data.get(k) for k in _PACKED})
+
+
+def archive_old(session, days: int | None = None, statuses: list[str] | None = None) -> int:
+    """条件に合うメールを ARCHIVE_BATCH 件ずつ移す。移した件数を返す"""
+    d, s = archive_settings()
+    days     = d if days is None else days
+    statuses = s if statuses is None else statuses
+    if not statuses:
+        return 0
+    cutoff = datetime.now() - timedelta(days=days)
+
+    moved = 0
+    while True:
+        rows = (session.query(EmailModel)
+                       .filter(EmailModel.date < cutoff, EmailModel.status.in_(statuses))
+                       .order_by(EmailModel.date)
+                       .limit(ARCHIVE_BATCH)
+                       .all())
+        if not rows:
+            break
+        keys = [(m.uidvalidity, m.uid) for m in rows]
+        archived = []
+        for m in rows:
+            payload, raw = _pack(m)
+            archived.append(ArchivedEmailModel(
+                uidvalidity=m.uidvalidity, uid=m.uid, message_id=m.message_id,
+                subject=m.subject, from_addr=m.from_addr, date=m.date,
+                status=m.status, fetched_at=m.fetched_at, payload=payload, raw_bytes=raw))
+        for m in rows:
+            session.expunge(m)
+        session.add_all(archived)
+        session.execute(delete(EmailModel)
+                        .where(tuple_(EmailModel.uidvalidity, EmailModel.uid).in_(keys))
+                        .execution_options(synchronize_session=False))
+        session.commit()        # 1 バッチ = 1 トランザクション（途中で止まっても整合）
+        moved += len(keys)
+    return moved
+
+
+def restore(session, a: ArchivedEmailModel) -> EmailModel:
+    """アーカイブ行を emails へ戻す（commit は呼び出し側のトランザクションで行う）"""
+    m = _unpack(a)
+    session.delete(a)
+    session.add(m)
+    return m
+
+
+def load(session, uv: int, uid: int) -> EmailModel | None:
+    """アーカイブから 1 通復元する（無ければ None）"""
+    a = session.get(ArchivedEmailModel, (uv, uid))
+    return _unpack(a) if a else None
+
+
+def search(session, q: str, limit: int = 100) -> list:
+    """件名・差出人で検索（本文は圧縮済みのため対象外）"""
+    like = f'%{q}%'
+    return (session.query(ArchivedEmailModel.uidvalidity, ArchivedEmailModel.uid,
+                          ArchivedEmailModel.subject, ArchivedEmailModel.from_addr,
+                          ArchivedEmailModel.date, ArchivedEmailModel.status)
+                   .filter(or_(ArchivedEmailModel.subject.ilike(like),
+                               ArchivedEmailModel.from_addr.ilike(like)))
+                   .order_by(ArchivedEmailModel.date.desc())
+                   .limit(limit)
+                   .all())
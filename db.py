@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+DB エンジン / セッションの共有モジュール。
+
+web のリクエストスレッドと APScheduler のスレッド（や CLI）が
+1 プロセスにつき 1 つのエンジン・コネクションプールを共有する。
+
+方言ごとの調整 ──────────────────────────────
+  SQLite      : 接続ごとに WAL / busy_timeout / synchronous=NORMAL を設定。
+                読み取りが書き込みを待たず、書き込み同士は busy_timeout の間だけ待つ
+  PostgreSQL  : pool_pre_ping 付きのプール（切れた接続を使う前に検知）
+
+環境変数と既定値 ──────────────────────────
+  DATABASE_URL            sqlite:///emails.db
+  DB_POOL_SIZE            5
+  DB_MAX_OVERFLOW         10     gunicorn の WEB_THREADS + スケジューラ分をまかなう
+  DB_POOL_RECYCLE         1800   （PostgreSQL）秒
+  SQLITE_BUSY_TIMEOUT_MS  30000
+"""
+
+import os
+
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+Base    = declarative_base()
+Session = sessionmaker()      # get_engine() で bind される
+_engine = None
+
+
+def database_url() -> str:
+    url = os.getenv('DATABASE_URL', 'sqlite:///emails.db')
+    # Heroku の "postgres://" は SQLAlchemy 2 では受け付けないので読み替える
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def _engine_options(url: str) -> dict:
+    opts = {
+        'pool_size'   : int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+    }
+    if url.startswith('sqlite'):
+        # インメモリ DB は SingletonThreadPool になり、プールサイズ指定を受け付けない
+        if make_url(url).database in (None, '', ':memory:'):
+            opts = {}
+        # スレッド間で接続を使い回すので check_same_thread は外す
+        opts['connect_args'] = {
+            'timeout'          : int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '30000')) / 1000,
+            'check_same_thread': False,
+        }
+    else:
+        opts['pool_pre_ping'] = True
+        opts['pool_recycle']  = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+    return opts
+
+
+def _tune_sqlite(dbapi_conn, _record):
+    """新しい SQLite 接続ごとに PRAGMA を設定する"""
+    busy_ms = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '30000'))
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute(f'PRAGMA busy_timeout={busy_ms}')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.close()
+
+
+def get_engine():
+    """プロセス共通のエンジンを返す（初回だけ生成し、Session を bind する）"""
+    global _engine
+    if _engine is None:
+        url = database_url()
+        _engine = create_engine(url, echo=False, future=True, **_engine_options(url))
+        if _engine.dialect.name == 'sqlite':
+            event.listen(_engine, 'connect', _tune_sqlite)
+        Session.configure(bind=_engine)
+    return _engine
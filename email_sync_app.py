@@ -16,46 +16,43 @@ Hourly で：  python email_sync_app.py --limit 20
 import os
 import re
 import sys
+import html
+import json
 import imaplib
 import email
 import argparse
+from urllib.parse import quote
 from email.header import decode_header
 from datetime import datetime, timedelta, timezone
 
-from bs4 import BeautifulSoup        # pip install beautifulsoup4
 from dotenv import load_dotenv       # pip install python-dotenv
 from sqlalchemy import (
-    create_engine, Column, BigInteger, String,
-    Text, DateTime, UniqueConstraint
+    Column, Integer, BigInteger, String,
+    Text, DateTime, LargeBinary, UniqueConstraint, inspect, text
 )
-from sqlalchemy.orm import declarative_base, sessionmaker
 
-# ---------------------------------------------------------------------------
-# Windows での日本語標準出力対策
-# ---------------------------------------------------------------------------
-if sys.platform.startswith('win'):
-    sys.stdout.reconfigure(encoding='utf-8')
-    sys.stderr.reconfigure(encoding='utf-8')
+from db import Base, Session, get_engine
+from mail_processor import extract_information
+from status_counts import DEFAULT_STATUS, StatusCountModel, StatusTotalModel, bump, day_of, reconcile
 
 # ---------------------------------------------------------------------------
-# .env 読み込み
+# 設定（.env の読み込みは呼び出し側 = CLI / create_app で行う）
 # ---------------------------------------------------------------------------
-load_dotenv()
-IMAP_HOST     = os.getenv('IMAP_HOST', 'imap.gmail.com')
-IMAP_PORT     = int(os.getenv('IMAP_PORT', '993'))
-IMAP_USER     = os.getenv('IMAP_USER')
-IMAP_PASSWORD = os.getenv('IMAP_PASSWORD')
-MAILBOX       = os.getenv('IMAP_MAILBOX', 'INBOX')
-DB_URL        = os.getenv('DATABASE_URL', 'sqlite:///emails.db')
 
-if not IMAP_USER or not IMAP_PASSWORD:
-    print('[ERROR] IMAP_USER / IMAP_PASSWORD が .env にありません', file=sys.stderr)
-    sys.exit(1)
+def _imap_settings() -> dict:
+    """IMAP 接続設定を環境変数から読む（import 時ではなく接続のたびに読む）"""
+    return {
+        'host'    : os.getenv('IMAP_HOST', 'imap.gmail.com'),
+        'port'    : int(os.getenv('IMAP_PORT', '993')),
+        'user'    : os.getenv('IMAP_USER'),
+        'password': os.getenv('IMAP_PASSWORD'),
+        'mailbox' : os.getenv('IMAP_MAILBOX', 'INBOX'),
+        'timeout' : float(os.getenv('IMAP_TIMEOUT', '30')),   # ソケット操作ごとのタイムアウト秒
+    }
 
 # ---------------------------------------------------------------------------
-# DB 定義
+# DB 定義（エンジン / セッションは db.py で共有）
 # ---------------------------------------------------------------------------
-Base = declarative_base()
 
 class EmailModel(Base):
     __tablename__ = 'emails'
@@ -69,9 +66,14 @@ class EmailModel(Base):
     to_addr      = Column(Text)
     date         = Column(DateTime)
     body         = Column(Text)
-    raw_content  = Column(Text)
-
-    status       = Column(String(20), default='新規')
+    body_html    = Column(Text)       # 画面にそのまま差し込める整形済み本文
+    image_urls   = Column(Text)       # 本文中の画像 URL（JSON 配列）
+    fields       = Column(Text)       # extract_information の結果（JSON）
+    customer_name = Column(Text)
+    raw_content  = Column(Text)       # UTF-8 として読めた部分だけ（非 UTF-8 の 8bit 本文は欠ける）
+    raw_bytes    = Column(LargeBinary) # 受信したままの RFC822（再解析はこちらを優先）
+
+    status       = Column(String(20), default=DEFAULT_STATUS)
     gpt_response = Column(Text)
     fetched_at   = Column(DateTime, default=datetime.now(timezone.utc))
 
@@ -79,9 +81,63 @@ class EmailModel(Base):
         UniqueConstraint('message_id', name='_message_id_uc'),
     )
 
-engine  = create_engine(DB_URL, echo=False, future=True)
-Session = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
+# 画面から付けるメモ・写真（emails とは (uidvalidity, uid) で紐づく）
+class NoteModel(Base):
+    __tablename__ = 'notes'
+    id          = Column(Integer, primary_key=True)
+    uidvalidity = Column(BigInteger, nullable=False)
+    uid         = Column(BigInteger, nullable=False)
+    page        = Column(Integer,  nullable=False)
+    content     = Column(Text,     default='')
+    uploaded_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class PhotoModel(Base):
+    __tablename__ = 'photos'
+    id          = Column(Integer, primary_key=True)
+    uidvalidity = Column(BigInteger, nullable=False)
+    uid         = Column(BigInteger, nullable=False)
+    filename    = Column(String(255), nullable=False)
+    uploaded_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# 後から増えたカラム（テーブルごと）
+_LATER_COLUMNS = {
+    'emails'        : ('body_html', 'image_urls', 'fields', 'customer_name', 'raw_bytes'),
+    'emails_archive': ('raw_bytes',),
+}
+
+
+def _add_missing_columns(engine):
+    """既存 DB に後から増えたカラムが無ければ追加する（create_all は ALTER しないため）"""
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table, names in _LATER_COLUMNS.items():
+            have = {c['name'] for c in insp.get_columns(table)}
+            cols = Base.metadata.tables[table].c
+            for name in names:
+                if name not in have:
+                    type_ = cols[name].type.compile(dialect=engine.dialect)   # BLOB / BYTEA など
+                    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {type_}'))
+
+
+def init_db():
+    """テーブル作成 + カラム追加。起動時に明示的に 1 回呼ぶ"""
+    import archive    # noqa: F401  emails_archive も create_all の対象にする
+    import locks      # noqa: F401  同上（locks）
+
+    engine = get_engine()
+    Base.metadata.create_all(engine)
+    _add_missing_columns(engine)
+
+    # カウンタ表（累計表）を新設した直後は既存メールから一度だけ集計する
+    session = Session()
+    try:
+        if (session.query(StatusTotalModel.status).first() is None
+                and (session.query(EmailModel.uid).first() is not None
+                     or session.query(StatusCountModel.status).first() is not None)):
+            reconcile(session)
+    finally:
+        session.close()
 
 # ---------------------------------------------------------------------------
 # 文字デコード util
@@ -115,6 +171,7 @@ def extract_body(msg: email.message.Message) -> str:
     if payload.get_content_type() == 'text/plain':
         text = raw.decode(charset, 'ignore')
     else:
+        from bs4 import BeautifulSoup    # pip install beautifulsoup4（html メールのときだけ読み込む）
         text = BeautifulSoup(raw, 'html.parser').get_text('\n')
 
     # 整形
@@ -122,17 +179,71 @@ def extract_body(msg: email.message.Message) -> str:
     text = re.sub(r'\s+\n', '\n', text)  # 空白→改行詰め
     return text.strip()
 
+# ---------------------------------------------------------------------------
+# 本文 → 表示用 HTML（旧 emails.html の fmtBody をサーバ側へ移植）
+# ---------------------------------------------------------------------------
+
+# 画像 URL（<...> や [...] で囲まれていてもまとめて拾う）
+_IMG_RE  = re.compile(r'(?:&lt;|\[)?\s*(https?://[^\s"\'<>]+\.(?:png|jpe?g|gif))\s*(?:\]|&gt;)?',
+                      re.IGNORECASE)
+_LINK_RE = re.compile(r'(https?://[^\s"\'<>]+)', re.IGNORECASE)
+
+
+def _proxy_src(url: str) -> str:
+    """JS の encodeURIComponent 相当で /proxy 経由の URL を作る"""
+    return '/proxy?url=' + quote(url, safe="-_.!~*'()")
+
+
+def render_body_html(text: str | None) -> tuple[str, list[str]]:
+    """本文テキストをエスケープし、画像サムネ化・リンク化した HTML と画像 URL 一覧を返す"""
+    if not text:
+        return '', []
+
+    image_urls: list[str] = []
+
+    def _thumb(m: re.Match) -> str:
+        url = html.unescape(m.group(1))
+        image_urls.append(url)
+        src = html.escape(_proxy_src(url))
+        return ('<br><span class="inline-wrap">'
+                f'<img class="inline-thumb" src="{src}">'
+                f'<a class="dl-link" href="{src}" download>DL</a>'
+                '</span><br>')
+
+    s = html.escape(text)
+    s = _IMG_RE.sub(_thumb, s)
+    s = _LINK_RE.sub(r'<a href="\1" target="_blank">\1</a>', s)
+    return s.replace('\n', '<br>'), image_urls
+
+
+def derive_columns(body: str) -> dict:
+    """本文から導出する列（表示用 HTML・画像 URL・構造化項目・顧客名）をまとめて作る。
+    取り込み時と reparse.py で共通"""
+    body_html, image_urls = render_body_html(body)
+    fields = extract_information(body or '')
+    name   = fields.get('お名前', '')
+    return {
+        'body_html'    : body_html,
+        'image_urls'   : json.dumps(image_urls, ensure_ascii=False),
+        'fields'       : json.dumps(fields, ensure_ascii=False),
+        'customer_name': '' if name == '情報なし' else name,
+    }
+
 # ---------------------------------------------------------------------------
 # 共通 IMAP ハンドラ
 # ---------------------------------------------------------------------------
 
 def _connect_imap() -> tuple[imaplib.IMAP4_SSL, int] | tuple[None, None]:
     """IMAP 接続して (imap, UIDVALIDITY) を返す。失敗時は (None, None)"""
+    cfg = _imap_settings()
+    if not cfg['user'] or not cfg['password']:
+        print('[ERROR] IMAP_USER / IMAP_PASSWORD が .env にありません', file=sys.stderr)
+        return None, None
     try:
-        imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT)
-        imap.login(IMAP_USER, IMAP_PASSWORD)
-        imap.select(MAILBOX)
-        status, d = imap.status(MAILBOX, '(UIDVALIDITY)')
+        imap = imaplib.IMAP4_SSL(cfg['host'], cfg['port'], timeout=cfg['timeout'])
+        imap.login(cfg['user'], cfg['password'])
+        imap.select(cfg['mailbox'])
+        status, d = imap.status(cfg['mailbox'], '(UIDVALIDITY)')
         uidvalidity = int(d[0].decode().split()[2].rstrip(')'))
         return imap, uidvalidity
     except Exception as e:
@@ -179,48 +290,59 @@ def fetch_past_month_and_save():
 # ---------------------------------------------------------------------------
 
 def _save_uids(imap: imaplib.IMAP4_SSL, uidvalidity: int, uids: list[int]):
+    from archive import ArchivedEmailModel    # archive が EmailModel を import するためここで
+
+    get_engine()
     session = Session()
     saved   = 0
 
-    for idx, uid in enumerate(uids, 1):
-        try:
-            status, msg_data = imap.uid('FETCH', str(uid), '(RFC822)')
-            if not msg_data or msg_data[0] is None:
+    try:
+        for idx, uid in enumerate(uids, 1):
+            try:
+                status, msg_data = imap.uid('FETCH', str(uid), '(RFC822)')
+                if not msg_data or msg_data[0] is None:
+                    continue
+                raw = msg_data[0][1]
+                msg = email.message_from_bytes(raw)
+            except Exception as e:
+                print(f'  [WARN] UID={uid} FETCH 失敗: {e}')
+                continue
+
+            subj = dec_mime(msg.get('Subject'))
+            if 'クリーニング見積もり' not in subj:
+                continue
+
+            mid = msg.get('Message-ID')
+            # アーカイブ済みのメールが再スキャンで戻ってきても取り込み直さない
+            if (session.query(EmailModel.uid).filter_by(message_id=mid).first()
+                    or session.query(ArchivedEmailModel.uid).filter_by(message_id=mid).first()):
                 continue
-            raw = msg_data[0][1]
-            msg = email.message_from_bytes(raw)
-        except Exception as e:
-            print(f'  [WARN] UID={uid} FETCH 失敗: {e}')
-            continue
-
-        subj = dec_mime(msg.get('Subject'))
-        if 'クリーニング見積もり' not in subj:
-            continue
-
-        mid = msg.get('Message-ID')
-        if session.query(EmailModel).filter_by(message_id=mid).first():
-            continue
-
-        try:
-            rec = EmailModel(
-                uidvalidity = uidvalidity,
-                uid         = uid,
-                message_id  = mid,
-                subject     = subj,
-                from_addr   = dec_mime(msg.get('From')),
-                to_addr     = dec_mime(msg.get('To')),
-                date        = email.utils.parsedate_to_datetime(msg.get('Date')),
-                body        = extract_body(msg),
-                raw_content = raw.decode('utf-8', 'ignore')
-            )
-            session.add(rec)
-            session.commit()
-            saved += 1
-        except Exception as e:
-            session.rollback()
-            print(f'  [ERROR] DB 保存失敗: {e}', file=sys.stderr)
-
-    session.close()
+
+            try:
+                body = extract_body(msg)
+                rec = EmailModel(
+                    uidvalidity = uidvalidity,
+                    uid         = uid,
+                    message_id  = mid,
+                    subject     = subj,
+                    from_addr   = dec_mime(msg.get('From')),
+                    to_addr     = dec_mime(msg.get('To')),
+                    date        = email.utils.parsedate_to_datetime(msg.get('Date')),
+                    body        = body,
+                    **derive_columns(body),
+                    raw_content = raw.decode('utf-8', 'ignore'),
+                    raw_bytes   = raw,
+                    status      = DEFAULT_STATUS
+                )
+                session.add(rec)
+                bump(session, rec.status, day_of(rec))   # 件数カウンタも同じトランザクションで
+                session.commit()
+                saved += 1
+            except Exception as e:
+                session.rollback()
+                print(f'  [ERROR] UID={uid} 解析/DB 保存失敗: {e}', file=sys.stderr)
+    finally:
+        session.close()
     print(f'[INFO] 保存完了: {saved} 件')
 
 # ---------------------------------------------------------------------------
@@ -228,6 +350,17 @@ def _save_uids(imap: imaplib.IMAP4_SSL, uidvalidity: int, uids: list[int]):
 # ---------------------------------------------------------------------------
 
 if __name__ == '__main__':
+    # Windows での日本語標準出力対策
+    if sys.platform.startswith('win'):
+        sys.stdout.reconfigure(encoding='utf-8')
+        sys.stderr.reconfigure(encoding='utf-8')
+
+    load_dotenv()
+    if not os.getenv('IMAP_USER') or not os.getenv('IMAP_PASSWORD'):
+        print('[ERROR] IMAP_USER / IMAP_PASSWORD が .env にありません', file=sys.stderr)
+        sys.exit(1)
+    init_db()
+
     parser = argparse.ArgumentParser(description='クリーニング見積もりメール同期ツール')
     parser.add_argument('--mode', choices=['latest', 'month'], default='latest',
                         help="latest: 直近 N 件 / month: 過去 1 か月分")
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+見積もりデータを CSV / XLSX に書き出す（経理・シーズン振り返り用）。
+
+行はサーバサイドカーソル（yield_per）で少しずつ読み、そのまま書き出すので
+件数が増えてもメモリ使用量は一定。
+
+CLI で実行するとき  ────────────────
+$ python export.py -o quotes.csv                                  # 全件を CSV
+$ python export.py -o quotes.xlsx --since 2025-04-01 --until 2025-09-30
+$ python export.py -o quotes.csv --status 依頼あり --status 荷物受け取り
+$ python export.py -o legacy.csv --source json                    # 顧客データ/*.json から
+
+$ python export.py -o quotes.csv --no-archived                   # アーカイブ分を除く
+
+web からは  /export?format=csv&since=2025-04-01&until=2025-09-30&status=依頼あり
+           （archived=0 でアーカイブ分を除く）
+
+列: uidvalidity, uid, date, status, subject, from_addr,
+    mail_processor.extract_information の各項目, notes（フリーメモ P1〜）
+--source json のときは期間・ステータス指定は使えない（JSON に日付・ステータスが無いため）。
+"""
+
+import os
+import io
+import csv
+import json
+import argparse
+import tempfile
+from datetime import date, datetime, time, timedelta
+from itertools import groupby
+
+from dotenv import load_dotenv
+from sqlalchemy import select, tuple_
+
+import archive
+from archive import ArchivedEmailModel
+from db import Session, get_engine
+from email_sync_app import EmailModel, NoteModel
+from mail_processor import DATA_DIR, extract_information
+
+FETCH_CHUNK = 500     # yield_per の件数
+
+FIELD_KEYS = list(extract_information('').keys())
+COLUMNS    = ['uidvalidity', 'uid', 'date', 'status', 'subject', 'from_addr',
+              *FIELD_KEYS, 'notes']
+
+# ---------------------------------------------------------------------------
+# 行の生成
+# ---------------------------------------------------------------------------
+
+def _notes_for(session, keys: list[tuple[int, int]]) -> dict[tuple[int, int], str]:
+    """チャンク内のメールのメモをまとめて取得し 'P1: ...' 形式に連結する"""
+    if not keys:
+        return {}
+    rows = session.execute(
+        select(NoteModel.uidvalidity, NoteModel.uid, NoteModel.page, NoteModel.content)
+        .where(tuple_(NoteModel.uidvalidity, NoteModel.uid).in_(keys))
+        .order_by(NoteModel.uidvalidity, NoteModel.uid, NoteModel.page)
+    )
+    out = {}
+    for key, notes in groupby(rows, key=lambda r: (r.uidvalidity, r.uid)):
+        out[key] = '\n'.join(f'P{n.page}: {n.content}' for n in notes if n.content)
+    return out
+
+
+def _filtered(stmt, model, since, until, statuses):
+    if since:
+        stmt = stmt.where(model.date >= datetime.combine(since, time.min))
+    if until:
+        stmt = stmt.where(model.date < datetime.combine(until + timedelta(days=1), time.min))
+    if statuses:
+        stmt = stmt.where(model.status.in_(statuses))
+    return stmt
+
+
+def _to_row(r, notes: dict, fields: str | None, body: str | None) -> dict:
+    row = {
+        'uidvalidity': r.uidvalidity,
+        'uid'        : r.uid,
+        'date'       : r.date.isoformat(sep=' ') if r.date else '',
+        'status'     : r.status or '',
+        'subject'    : r.subject or '',
+        'from_addr'  : r.from_addr or '',
+        'notes'      : notes.get((r.uidvalidity, r.uid), ''),
+    }
+    # 取り込み時に解析済みならそれを使い、古い行だけここで解析
+    row.update(json.loads(fields) if fields else extract_information(body or ''))
+    return row
+
+
+def iter_db_rows(session, since: date | None = None, until: date | None = None,
+                 statuses: list[str] | None = None, include_archived: bool = True):
+    """emails（既定ではアーカイブ分も）から 1 行ずつ dict を返す。until はその日を含む
+
+    アーカイブ分は日付が古いので先に出す。payload の展開は 1 行ずつ行う。
+    """
+    if include_archived:
+        stmt = (select(ArchivedEmailModel.uidvalidity, ArchivedEmailModel.uid,
+                       ArchivedEmailModel.date, ArchivedEmailModel.status,
+                       ArchivedEmailModel.subject, ArchivedEmailModel.from_addr,
+                       ArchivedEmailModel.payload)
+                .order_by(ArchivedEmailModel.date, ArchivedEmailModel.uidvalidity,
+                          ArchivedEmailModel.uid)
+                .execution_options(yield_per=FETCH_CHUNK))
+        stmt = _filtered(stmt, ArchivedEmailModel, since, until, statuses)
+        for part in session.execute(stmt).partitions():
+            notes = _notes_for(session, [(r.uidvalidity, r.uid) for r in part])
+            for r in part:
+                data = archive.unpack_payload(r.payload)
+                yield _to_row(r, notes, data.get('fields'), data.get('body'))
+
+    stmt = (select(EmailModel.uidvalidity, EmailModel.uid, EmailModel.date,
+                   EmailModel.status, EmailModel.subject, EmailModel.from_addr,
+                   EmailModel.body, EmailModel.fields)
+            .order_by(EmailModel.date, EmailModel.uidvalidity, EmailModel.uid)
+            .execution_options(yield_per=FETCH_CHUNK))
+    stmt = _filtered(stmt, EmailModel, since, until, statuses)
+    for part in session.execute(stmt).partitions():
+        notes = _notes_for(session, [(r.uidvalidity, r.uid) for r in part])
+        for r in part:
+            yield _to_row(r, notes, r.fields, r.body)
+
+
+def iter_json_rows(data_dir: str = DATA_DIR):
+    """旧バッチ（mail_processor.py）が保存した 顧客データ/*.json から 1 行ずつ返す"""
+    names = sorted((e.name for e in os.scandir(data_dir) if e.name.endswith('.json')),
+                   key=lambda n: (len(n), n))
+    for name in names:
+        with open(os.path.join(data_dir, name), encoding='utf-8') as f:
+            info = json.load(f)
+        row = {k: info.get(k, '') for k in FIELD_KEYS}
+        row.update(uid=info.get('ID', ''), subject=info.get('subject', ''))
+        yield row
+
+# ---------------------------------------------------------------------------
+# 書き出し
+# ---------------------------------------------------------------------------
+
+def iter_csv(rows):
+    """CSV を行ごとの文字列で返す（先頭に Excel 向けの BOM）"""
+    buf = io.StringIO()
+    # 保存済み fields に古い項目名が残っていても落ちないよう、COLUMNS 以外は捨てる
+    writer = csv.DictWriter(buf, fieldnames=COLUMNS, restval='', extrasaction='ignore')
+    writer.writeheader()
+    yield '\ufeff' + buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        yield buf.getvalue()
+
+
+def write_xlsx(rows, fp):
+    """write-only モードで XLSX を書く（行はディスク上の一時 XML に流れる）"""
+    from openpyxl import Workbook        # pip install openpyxl（XLSX のときだけ必要）
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('quotes')
+    ws.append(COLUMNS)
+    for row in rows:
+        ws.append([row.get(c, '') for c in COLUMNS])
+    wb.save(fp)
+
+
+def xlsx_tempfile(rows):
+    """XLSX を一時ファイルに書き、読み出し位置を先頭に戻したファイルを返す"""
+    tmp = tempfile.TemporaryFile()
+    write_xlsx(rows, tmp)
+    tmp.seek(0)
+    return tmp
+
+
+def parse_date(val: str | None) -> date | None:
+    return date.fromisoformat(val) if val else None
+
+# ---------------------------------------------------------------------------
+# CLI エントリポイント
+# ---------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='見積もりデータ CSV / XLSX エクスポート')
+    parser.add_argument('-o', '--output', required=True,
+                        help='出力ファイル（拡張子 .xlsx なら XLSX、それ以外は CSV）')
+    parser.add_argument('--source', choices=['db', 'json'], default='db',
+                        help='db: emails テーブル / json: 顧客データ/*.json')
+    parser.add_argument('--since', type=parse_date, help='この日以降（YYYY-MM-DD）')
+    parser.add_argument('--until', type=parse_date, help='この日まで（YYYY-MM-DD、当日を含む）')
+    parser.add_argument('--status', action='append', help='ステータスで絞り込み（複数指定可）')
+    parser.add_argument('--no-archived', dest='include_archived', action='store_false',
+                        help='アーカイブ（emails_archive）の分を含めない')
+    args = parser.parse_args()
+
+    load_dotenv()
+    session = None
+    if args.source == 'db':
+        get_engine()
+        session = Session()
+        rows = iter_db_rows(session, args.since, args.until, args.status, args.include_archived)
+    else:
+        if args.since or args.until or args.status:
+            parser.error('--source json では --since / --until / --status は使えません')
+        rows = iter_json_rows()
+
+    try:
+        if args.output.lower().endswith('.xlsx'):
+            with open(args.output, 'wb') as f:
+                write_xlsx(rows, f)
+        else:
+            with open(args.output, 'w', encoding='utf-8', newline='') as f:
+                f.writelines(iter_csv(rows))
+    finally:
+        if session is not None:
+            session.close()
+    print(f'[INFO] 書き出し完了: {args.output}')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 設定ファイル（Procfile から -c で読み込む。アプリは "app:create_app()" で生成）。
+
+WEB_MODE で worker 種別を選ぶ ─────────────────
+  gthread（既定）: スレッドワーカー。/proxy や /sync_now が外部を待っている間も
+                   同じ worker の別スレッドが一覧・詳細などを返せる
+  sync           : 従来どおりの同期ワーカー（1 worker = 同時 1 リクエスト）
+
+環境変数と既定値 ──────────────────────────
+  WEB_MODE         gthread
+  WEB_CONCURRENCY  2      worker プロセス数
+  WEB_THREADS      8      gthread 時の 1 worker あたりスレッド数
+  WEB_TIMEOUT      60     無応答 worker を再起動するまでの秒数
+  PORT             5000
+  RUN_SCHEDULER    （なし） 1 なら master プロセスで定期ジョブを動かす（worker dyno を使わない運用向け）
+
+外向き I/O の同時実行数・タイムアウトは app.py 側（PROXY_* / IMAP_TIMEOUT）で制御する。
+WEB_THREADS は PROXY_MAX_CONCURRENCY より大きくしておくこと
+（画像取得だけでスレッドを使い切らないようにするため）。
+"""
+
+import os
+
+WEB_MODE = os.getenv('WEB_MODE', 'gthread')
+if WEB_MODE not in ('gthread', 'sync'):
+    raise ValueError(f'WEB_MODE は gthread / sync のいずれか: {WEB_MODE!r}')
+
+bind         = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = WEB_MODE
+workers      = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads      = int(os.getenv('WEB_THREADS', '8')) if WEB_MODE == 'gthread' else 1
+timeout      = int(os.getenv('WEB_TIMEOUT', '60'))
+keepalive    = 5
+accesslog    = '-'
+
+
+def when_ready(server):
+    """RUN_SCHEDULER=1 ならスケジューラを master で 1 つだけ起動する（worker ごとには起動しない）"""
+    if os.getenv('RUN_SCHEDULER') != '1':
+        return
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from app import build_scheduler
+    from db import get_engine
+    get_engine()
+    build_scheduler().start()
+    server.log.info('Scheduler started in master (pid %s)', os.getpid())
+
+
+def post_fork(server, worker):
+    """master のスケジューラが使っているコネクションを worker に持ち込まない"""
+    import sys
+    db = sys.modules.get('db')
+    if db is not None and db._engine is not None:
+        db._engine.dispose(close=False)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+プロセスをまたぐ排他（IMAP 同期・夜間ジョブ）。
+
+gunicorn の各 worker・スケジューラ・CLI は別プロセスなので threading.Lock では守れない。
+locks テーブルに名前付きの行を 1 行 INSERT できたプロセスだけが実行し、
+主キーが重複したら他のプロセスが実行中とみなして諦める（待たない）。
+落ちたプロセスが残したロックは LOCK_TTL 秒たてば次に取りに来たプロセスが消して取り直す。
+
+環境変数と既定値 ──────────────────────────
+  LOCK_TTL  3600    秒。いちばん長いジョブ（flask backfill）より長くしておくこと
+"""
+
+import os
+import socket
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import Column, String, DateTime, delete
+from sqlalchemy.exc import IntegrityError
+
+from db import Base, Session, get_engine
+
+
+class LockModel(Base):
+    __tablename__ = 'locks'
+
+    name      = Column(String(50),  primary_key=True)
+    owner     = Column(String(100), nullable=False)     # ホスト名:PID:乱数
+    locked_at = Column(DateTime,    nullable=False)
+
+
+def acquire(name: str) -> str | None:
+    """ロックを取れたら解放用のトークンを、他が持っていれば None を返す"""
+    get_engine()
+    token = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+    now   = datetime.now()
+    ttl   = int(os.getenv('LOCK_TTL', '3600'))
+    session = Session()
+    try:
+        session.execute(delete(LockModel)
+                        .where(LockModel.name == name,
+                               LockModel.locked_at < now - timedelta(seconds=ttl)))
+        session.add(LockModel(name=name, owner=token, locked_at=now))
+        session.commit()
+        return token
+    except IntegrityError:
+        session.rollback()
+        return None
+    finally:
+        session.close()
+
+
+def release(name: str, token: str):
+    """自分が取ったロックだけを外す（TTL 切れで他に取られていたら何もしない）"""
+    session = Session()
+    try:
+        session.execute(delete(LockModel).where(LockModel.name == name, LockModel.owner == token))
+        session.commit()
+    finally:
+        session.close()
+
+
+@contextmanager
+def hold(name: str):
+    """with hold('imap_sync') as got: ... got が False なら他のプロセスが実行中"""
+    token = acquire(name)
+    try:
+        yield token is not None
+    finally:
+        if token is not None:
+            release(name, token)
@@ -17,11 +17,6 @@ PASSWORD = "tripkjkafhpipwvt"  # 安全な方法でパスワードを設定し
 DATA_DIR = os.path.join(os.path.dirname(__file__), "顧客データ")
 START_ID = 10003
 
-# ディレクトリが存在しない場合は作成
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
-    print(f"ディレクトリ {DATA_DIR} を作成しました。")
-
 def extract_information(body):
     # 正規表現パターン
     patterns = {
@@ -142,6 +137,11 @@ def process_mail(processed_ids):
 
 # メインループ
 if __name__ == "__main__":
+    # ディレクトリが存在しない場合は作成（import 時には作らない）
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+        print(f"ディレクトリ {DATA_DIR} を作成しました。")
+
     processed_ids = get_processed_ids()  # 処理済みメールIDの読み込み
     print("処理済みメールID:", processed_ids)
 
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+保存済みの元メールから本文・表示用 HTML・構造化項目を作り直す。
+
+email_sync_app.extract_body や mail_processor.extract_information を直したあと、
+IMAP から取り直さずに emails と emails_archive を更新するためのツール。
+emails を終えたら emails_archive も同じように処理する（payload を展開して作り直し、
+圧縮し直して書き戻す。body_html / image_urls はアーカイブでは持たない）。
+解析はプロセスプールでチャンクごとに並列実行し、書き戻しはチャンク単位の一括 UPDATE。
+書き戻したチャンクの最後のキーをチェックポイントに残すので、中断しても続きから再開できる。
+解析に失敗したメールは UID を警告に出して更新せずに飛ばす（チャンクの残りは書き戻す）。
+
+元データは raw_bytes（受信したままのバイト列）を優先する。raw_bytes が無い古い行は
+raw_content（decode('utf-8', 'ignore') で保存）から読むが、Shift_JIS や charset 指定なしなど
+UTF-8 と明示されていない 8bit 本文はバイトが欠けていて復元できないので、そういう行は
+更新せずに飛ばす（--dry-run でも表示）。
+
+CLI で実行するとき  ────────────────
+$ python reparse.py                        # 全件を再解析して書き戻す（続きがあれば続きから）
+$ python reparse.py --dry-run              # 書き込まずに変わる箇所の差分だけ表示
+$ python reparse.py --restart              # チェックポイントを捨てて最初から
+$ python reparse.py --workers 4 --chunk 200
+"""
+
+import os
+import sys
+import json
+import email
+import difflib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+from sqlalchemy import select, update, or_, tuple_
+
+from archive import ArchivedEmailModel, pack_payload, unpack_payload, unpack_raw
+from db import Session, get_engine
+from email_sync_app import EmailModel, extract_body, derive_columns
+
+CHECKPOINT = os.getenv('REPARSE_CHECKPOINT', 'reparse_checkpoint.json')
+
+# 処理するテーブル（この順）と、差分表示の対象列
+_TABLES  = ('emails', 'emails_archive')
+_COLUMNS = {
+    'emails'        : ('body', 'body_html', 'image_urls', 'fields', 'customer_name'),
+    'emails_archive': ('body', 'fields', 'customer_name'),
+}
+
+# raw_content に欠けなく残る charset
+_UTF8_CHARSETS  = {'utf-8', 'utf8'}
+_7BIT_CHARSETS  = _UTF8_CHARSETS | {'us-ascii', 'ascii', 'iso-2022-jp', 'utf-7'}   # 7bit で送れるもの
+
+# ---------------------------------------------------------------------------
+# 解析（ワーカープロセス側）
+# ---------------------------------------------------------------------------
+
+def reparse_raw(raw: bytes) -> dict:
+    """RFC822 1 通分から emails の _COLUMNS の値を作る"""
+    msg  = email.message_from_bytes(raw)
+    body = extract_body(msg)
+    return {'body': body, **derive_columns(body)}
+
+
+def is_lossy(raw_content: str) -> bool:
+    """raw_content から本文の元のバイトが欠けているかもしれないか。
+
+    text パートのうち、8bit / binary で charset が UTF-8 と明示されていないもの
+    （charset なし・HTML の <meta> だけで指定、も含む）と、7bit と称して
+    非 UTF-8 の 8bit charset を名乗るものを欠けているとみなす。
+    """
+    msg = email.message_from_string(raw_content)
+    for part in msg.walk():
+        if part.get_content_maintype() != 'text' or not part.get_payload():
+            continue
+        cte     = (part.get('Content-Transfer-Encoding') or '7bit').strip().lower()
+        charset = (part.get_content_charset() or '').lower()
+        if cte in ('base64', 'quoted-printable'):
+            continue
+        if cte in ('8bit', 'binary'):
+            if charset not in _UTF8_CHARSETS:
+                return True
+        elif charset and charset not in _7BIT_CHARSETS:
+            return True
+    return False
+
+
+def _reparse_one(table: str, raw_bytes: bytes | None, other) -> dict:
+    """1 通分の書き戻す値を返す。other は emails なら raw_content、アーカイブなら payload"""
+    data = None
+    if table == 'emails':
+        raw_content = other
+    else:
+        data        = unpack_payload(other)
+        raw_bytes   = unpack_raw(raw_bytes)
+        raw_content = data.get('raw_content')
+
+    if raw_bytes is None:
+        if raw_content is None:
+            return {'skip': '元のメールが残っておらず復元できない'}
+        if is_lossy(raw_content):
+            return {'skip': 'raw_content の 8bit 本文が UTF-8 と明示されておらず復元できない'}
+    cols = reparse_raw(raw_bytes if raw_bytes is not None else raw_content.encode('utf-8'))
+    if data is not None:
+        cols['payload'] = pack_payload({**data, **cols})
+    return cols
+
+
+def _reparse_chunk(table: str, chunk: list[tuple[int, int, bytes | None, object]]) -> list[dict]:
+    """チャンクを解析する。解析できない・元データが欠けているメールは
+    'error' / 'skip' 付きで返し、チャンク全体は止めない"""
+    out = []
+    for uv, uid, raw_bytes, other in chunk:
+        try:
+            out.append({'uidvalidity': uv, 'uid': uid, **_reparse_one(table, raw_bytes, other)})
+        except Exception as e:
+            out.append({'uidvalidity': uv, 'uid': uid, 'error': f'{type(e).__name__}: {e}'})
+    return out
+
+
+def _split(results: list[dict]) -> list[dict]:
+    """エラー・対象外の分をログに出し、書き戻す分だけを返す"""
+    ok = []
+    for r in results:
+        if 'error' in r:
+            print(f"  [WARN] UIDVALIDITY={r['uidvalidity']} UID={r['uid']} 解析失敗のため更新しません: "
+                  f"{r['error']}", file=sys.stderr)
+        elif 'skip' in r:
+            print(f"  [SKIP] UIDVALIDITY={r['uidvalidity']} UID={r['uid']} {r['skip']}ため更新しません",
+                  file=sys.stderr)
+        else:
+            ok.append(r)
+    return ok
+
+# ---------------------------------------------------------------------------
+# チェックポイント
+# ---------------------------------------------------------------------------
+
+def load_checkpoint() -> tuple[str, tuple[int, int]] | None:
+    """(テーブル名, 書き戻し済みの最後のキー) を返す"""
+    if not os.path.exists(CHECKPOINT):
+        return None
+    with open(CHECKPOINT, encoding='utf-8') as f:
+        cp = json.load(f)
+    return cp.get('table', 'emails'), tuple(cp['after'])
+
+
+def save_checkpoint(table: str, after: tuple[int, int], done: int):
+    tmp = CHECKPOINT + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'table': table, 'after': list(after), 'done': done}, f)
+    os.replace(tmp, CHECKPOINT)     # 書きかけのファイルを残さない
+
+# ---------------------------------------------------------------------------
+# 読み出し・書き戻し（メインプロセス側）
+# ---------------------------------------------------------------------------
+
+def _model(table: str):
+    return EmailModel if table == 'emails' else ArchivedEmailModel
+
+
+def iter_chunks(session, table: str, after: tuple[int, int] | None, size: int):
+    """(uidvalidity, uid) 順に size 件ずつ返す。キー位置で続きを読むので途中再開できる"""
+    model = _model(table)
+    key   = tuple_(model.uidvalidity, model.uid)
+    while True:
+        if table == 'emails':
+            stmt = (select(EmailModel.uidvalidity, EmailModel.uid,
+                           EmailModel.raw_bytes, EmailModel.raw_content)
+                    .where(or_(EmailModel.raw_bytes.is_not(None), EmailModel.raw_content.is_not(None))))
+        else:
+            stmt = select(ArchivedEmailModel.uidvalidity, ArchivedEmailModel.uid,
+                          ArchivedEmailModel.raw_bytes, ArchivedEmailModel.payload)
+        stmt = stmt.order_by(model.uidvalidity, model.uid).limit(size)
+        if after:
+            stmt = stmt.where(key > tuple_(*after))
+        chunk = [tuple(r) for r in session.execute(stmt)]
+        session.rollback()      # 読み取りトランザクションを閉じて書き込みを待たせない
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1][:2]
+
+
+def write_back(session, table: str, results: list[dict]):
+    if results:
+        if table == 'emails':
+            session.execute(update(EmailModel), results)    # 主キー指定の一括 UPDATE
+        else:
+            session.execute(update(ArchivedEmailModel),
+                            [{'uidvalidity': r['uidvalidity'], 'uid': r['uid'], 'payload': r['payload']}
+                             for r in results])
+    session.commit()
+
+
+def _current(session, table: str, keys: list[tuple[int, int]]) -> dict[tuple[int, int], dict]:
+    """差分表示用に、いま保存されている _COLUMNS の値を読む"""
+    model = _model(table)
+    where = tuple_(model.uidvalidity, model.uid).in_(keys)
+    if table == 'emails':
+        rows = session.execute(select(EmailModel.uidvalidity, EmailModel.uid,
+                                      *(getattr(EmailModel, k) for k in _COLUMNS[table])).where(where))
+        cur  = {(r.uidvalidity, r.uid): dict(r._mapping) for r in rows}
+    else:
+        rows = session.execute(select(ArchivedEmailModel.uidvalidity, ArchivedEmailModel.uid,
+                                      ArchivedEmailModel.payload).where(where))
+        cur  = {(r.uidvalidity, r.uid): unpack_payload(r.payload) for r in rows}
+    session.rollback()
+    return cur
+
+
+def print_diff(session, table: str, results: list[dict]) -> int:
+    """現在の値と比べて変わる箇所を表示し、変わるメールの件数を返す"""
+    cur = _current(session, table, [(r['uidvalidity'], r['uid']) for r in results])
+
+    changed = 0
+    for r in results:
+        old  = cur[(r['uidvalidity'], r['uid'])]
+        cols = [k for k in _COLUMNS[table] if (old.get(k) or '') != (r[k] or '')]
+        if not cols:
+            continue
+        changed += 1
+        print(f"=== {table} UIDVALIDITY={r['uidvalidity']} UID={r['uid']}: {', '.join(cols)}")
+        if 'body' in cols:
+            for line in difflib.unified_diff((old['body'] or '').splitlines(), r['body'].splitlines(),
+                                             'body (現在)', 'body (再解析)', n=1, lineterm=''):
+                print(line)
+        if 'fields' in cols:
+            before = json.loads(old['fields']) if old['fields'] else {}
+            after  = json.loads(r['fields'])
+            for k in after:
+                if before.get(k) != after[k]:
+                    print(f'  {k}: {before.get(k)!r} → {after[k]!r}')
+    return changed
+
+
+def run(workers: int, chunk_size: int, dry_run: bool = False, restart: bool = False):
+    get_engine()
+    session = Session()
+
+    if restart and os.path.exists(CHECKPOINT):
+        os.remove(CHECKPOINT)
+    resume  = None if dry_run else load_checkpoint()
+    done    = 0
+    failed  = 0
+    skipped = 0
+    if resume:
+        table, (uv, uid) = resume
+        print(f'[INFO] チェックポイントから再開: {table} UIDVALIDITY={uv} UID={uid}')
+
+    def flush(table: str, results: list[dict]):
+        nonlocal done, failed, skipped
+        ok = _split(results)
+        failed  += sum('error' in r for r in results)
+        skipped += sum('skip' in r for r in results)
+        done    += len(results)
+        if dry_run:
+            n = print_diff(session, table, ok) if ok else 0
+            print(f'[INFO] {done} 件確認（このチャンクで変わるもの {n} 件）', file=sys.stderr)
+            return
+        write_back(session, table, ok)
+        # 解析失敗分も含めてチャンク末尾まで進める（再開しても同じ行で止まらないように）
+        last = results[-1]
+        save_checkpoint(table, (last['uidvalidity'], last['uid']), done)
+        print(f'[INFO] {done} 件処理', file=sys.stderr)
+
+    # 提出はワーカー数の 2 倍までに抑え、結果は提出順に書き戻す（チェックポイントが単調に進む）
+    tables = _TABLES[_TABLES.index(resume[0]):] if resume else _TABLES
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for table in tables:
+            after   = resume[1] if resume and table == resume[0] else None
+            pending = deque()
+            for chunk in iter_chunks(session, table, after, chunk_size):
+                pending.append(pool.submit(_reparse_chunk, table, chunk))
+                if len(pending) >= workers * 2:
+                    flush(table, pending.popleft().result())
+            while pending:
+                flush(table, pending.popleft().result())
+
+    session.close()
+    if not dry_run and os.path.exists(CHECKPOINT):
+        os.remove(CHECKPOINT)       # 最後まで終わったら次回は最初から
+    print(f'[INFO] 完了: {done} 件（うち解析失敗でスキップ {failed} 件、'
+          f'raw_content が欠けていて対象外 {skipped} 件）')
+    if dry_run and skipped:
+        print('[INFO] 対象外の行は raw_bytes が無く、raw_content からは元の本文を復元できません。'
+              '現在の値のまま残します')
+
+# ---------------------------------------------------------------------------
+# CLI エントリポイント
+# ---------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='保存済みメールの再解析')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='解析プロセス数 (default: CPU 数)')
+    parser.add_argument('--chunk', type=int, default=200,
+                        help='1 チャンクの件数 (default: 200)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='書き込まずに差分だけ表示する')
+    parser.add_argument('--restart', action='store_true',
+                        help='チェックポイントを無視して最初からやり直す')
+    args = parser.parse_args()
+
+    load_dotenv()
+    run(args.workers, args.chunk, dry_run=args.dry_run, restart=args.restart)
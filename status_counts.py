@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+ステータス別・日別のメール件数カウンタ。
+
+emails を COUNT(*) / GROUP BY せずにサイドバーのバッジを出すための集計テーブル。
+  - status_counts はステータス×日、status_totals はステータスごとの累計（バッジはこちらだけ読む）
+  - 取り込み時・ステータス変更時に、同じトランザクション内で bump() する（両方を更新）
+  - ずれた場合に備えて reconcile() で emails から作り直す（スケジューラで毎晩）
+  - アーカイブ（archive.py）へ移したメールも数に含める
+"""
+
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Column, Date, Integer, String, func, select, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import Base
+
+DEFAULT_STATUS = '新規'
+# 画面から選べるステータス（emails.html の STATUSES と同じ）。DEFAULT_STATUS は取り込み時だけ付く
+STATUSES = ('未対応', '見積メール送信済', '依頼あり', '荷物受け取り', '荷物返送済み')
+
+# 方言ごとの upsert 用 insert（ON CONFLICT DO UPDATE が使えるもの）
+_UPSERT = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+class StatusCountModel(Base):
+    __tablename__ = 'status_counts'
+
+    status = Column(String(20), primary_key=True)
+    day    = Column(Date,       primary_key=True)   # メールの Date ヘッダの日付
+    count  = Column(Integer,    nullable=False, default=0)
+
+
+class StatusTotalModel(Base):
+    __tablename__ = 'status_totals'
+
+    status = Column(String(20), primary_key=True)
+    count  = Column(Integer,    nullable=False, default=0)
+
+
+def day_of(m) -> date:
+    """カウンタの日付キー（Date ヘッダが無ければ取得日時）"""
+    return (m.date or m.fetched_at or datetime.now()).date()
+
+
+def upsert_stmt(dialect: str, model, key: dict, delta: int):
+    """INSERT ... ON CONFLICT (主キー) DO UPDATE SET count = count + delta の文を作る"""
+    stmt = _UPSERT[dialect](model).values(**key, count=delta)
+    return stmt.on_conflict_do_update(
+        index_elements=list(key),
+        set_={'count': model.count + stmt.excluded.count},
+    )
+
+
+def bump(session, status: str | None, day: date, delta: int = 1):
+    """日別カウンタと累計を delta だけ増減する。commit は呼び出し側のトランザクションで行う
+
+    SQLite / PostgreSQL では INSERT ... ON CONFLICT DO UPDATE で 1 文にまとめ、
+    web と スケジューラが同時に同じ (status, day) を初めて数えても主キー重複にならないようにする。
+    """
+    status = status or DEFAULT_STATUS
+    dialect = session.get_bind().dialect.name
+    for model, key in ((StatusCountModel, {'status': status, 'day': day}),
+                       (StatusTotalModel, {'status': status})):
+        if dialect in _UPSERT:
+            session.execute(upsert_stmt(dialect, model, key, delta))
+            continue
+        res = session.execute(update(model).filter_by(**key).values(count=model.count + delta))
+        if res.rowcount == 0:
+            session.add(model(**key, count=delta))
+
+
+def totals(session) -> dict[str, int]:
+    """ステータスごとの合計（status_totals をそのまま読む。ステータスの種類数の行だけ）"""
+    rows = session.execute(select(StatusTotalModel.status, StatusTotalModel.count)
+                           .where(StatusTotalModel.count != 0))
+    return {status: n for status, n in rows}
+
+
+def by_day(session, days: int) -> dict[str, dict[str, int]]:
+    """直近 days 日分の {日付: {ステータス: 件数}}"""
+    since = date.today() - timedelta(days=days - 1)
+    rows = session.execute(
+        select(StatusCountModel.status, StatusCountModel.day, StatusCountModel.count)
+        .where(StatusCountModel.day >= since, StatusCountModel.count != 0)
+        .order_by(StatusCountModel.day)
+    )
+    out: dict[str, dict[str, int]] = {}
+    for status, day, n in rows:
+        out.setdefault(day.isoformat(), {})[status] = n
+    return out
+
+
+def _count_rows(session, model) -> dict[tuple[str, date], int]:
+    day = func.date(func.coalesce(model.date, model.fetched_at))
+    rows = session.execute(
+        select(func.coalesce(model.status, DEFAULT_STATUS), day, func.count())
+        .group_by(func.coalesce(model.status, DEFAULT_STATUS), day)
+    )
+    out = {}
+    for status, d, n in rows:
+        if d is None:
+            continue
+        if isinstance(d, str):          # SQLite の date() は文字列を返す
+            d = date.fromisoformat(d)
+        out[(status, d)] = out.get((status, d), 0) + n
+    return out
+
+
+def reconcile(session) -> int:
+    """emails（とアーカイブ）から集計し直してカウンタを置き換える。書き込んだ行数を返す"""
+    from email_sync_app import EmailModel
+    from archive import ArchivedEmailModel
+
+    counts = _count_rows(session, EmailModel)
+    for key, n in _count_rows(session, ArchivedEmailModel).items():
+        counts[key] = counts.get(key, 0) + n
+    by_status: dict[str, int] = {}
+    for (s, _), n in counts.items():
+        by_status[s] = by_status.get(s, 0) + n
+    session.execute(delete(StatusCountModel))
+    session.execute(delete(StatusTotalModel))
+    session.add_all(StatusCountModel(status=s, day=d, count=n) for (s, d), n in counts.items())
+    session.add_all(StatusTotalModel(status=s, count=n) for s, n in by_status.items())
+    session.commit()
+    return len(counts)
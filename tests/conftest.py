@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from email_sync_app import EmailModel  # noqa: E402
+
+SUBJECT = '=?utf-8?b?44Kv44Oq44O844OL44Oz44Kw6KaL56mN44KC44KK?='   # クリーニング見積もり
+
+
+@pytest.fixture
+def sqlite_file_db(tmp_path, monkeypatch):
+    """tmp 上のファイル SQLite を DATABASE_URL に向け、共有エンジンを作り直す"""
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'emails.db'}")
+    monkeypatch.setattr(db, '_engine', None)
+    engine = db.get_engine()
+    yield engine
+    engine.dispose()
+
+
+def make_raw(uid: int, body: bytes = b'body', charset: str = 'utf-8', cte: str = '8bit') -> bytes:
+    """取り込み対象（件名「クリーニング見積もり」）の RFC822 メッセージを作る"""
+    return (f'Subject: {SUBJECT}\r\n'
+            f'Message-ID: <{uid}@test>\r\n'
+            'Date: Mon, 1 Jan 2024 00:00:00 +0900\r\n'
+            f'Content-Type: text/plain; charset={charset}\r\n'
+            f'Content-Transfer-Encoding: {cte}\r\n'
+            '\r\n').encode() + body + b'\r\n'
+
+
+def add_email(sess, uid: int, fields: dict | None = None, raw: bytes | None = None,
+              with_bytes: bool = True, **kw):
+    """emails に 1 行足す（commit は呼び出し側）。kw で各列の既定値を上書きできる
+
+    raw を渡すと取り込み時と同じく raw_content / raw_bytes も入れる。
+    with_bytes=False は raw_bytes 列ができる前に取り込んだ行。
+    """
+    cols = dict(uidvalidity=1, uid=uid, message_id=f'<{uid}@test>',
+                subject='クリーニング見積もり', date=datetime(2024, 1, 1),
+                status='依頼あり', body='９. お名前 : 山田',
+                fields=json.dumps(fields, ensure_ascii=False) if fields else None)
+    if raw is not None:
+        cols.update(raw_content=raw.decode('utf-8', 'ignore'),
+                    raw_bytes=raw if with_bytes else None)
+    cols.update(kw)
+    sess.add(EmailModel(**cols))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""archive: 圧縮して移したメールが元どおりに復元できること"""
+
+import json
+import zlib
+
+import db
+import email_sync_app
+from archive import ArchivedEmailModel, archive_old, load, unpack_payload
+from conftest import add_email, make_raw
+from email_sync_app import render_body_html
+
+
+def test_raw_bytes_are_stored_once_and_restored(sqlite_file_db):
+    email_sync_app.init_db()
+    raw  = make_raw(1, '写真 <https://ex.com/a.png>'.encode())
+    body = '写真 <https://ex.com/a.png>'
+    sess = db.Session()
+    add_email(sess, 1, raw=raw, body=body, status='荷物返送済み')
+    add_email(sess, 2, raw=make_raw(2), with_bytes=False, status='荷物返送済み')
+    sess.commit()
+
+    try:
+        assert archive_old(sess, days=0) == 2
+        a1, a2 = sess.get(ArchivedEmailModel, (1, 1)), sess.get(ArchivedEmailModel, (1, 2))
+        assert zlib.decompress(a1.raw_bytes) == raw
+        assert unpack_payload(a1.payload)['raw_content'] is None     # raw_bytes から作れる
+        assert 'body_html' not in unpack_payload(a1.payload)
+        assert a2.raw_bytes is None
+        assert unpack_payload(a2.payload)['raw_content'] == make_raw(2).decode()
+
+        m = load(sess, 1, 1)
+        assert m.raw_bytes == raw
+        assert m.raw_content == raw.decode()
+        body_html, image_urls = render_body_html(body)
+        assert (m.body_html, json.loads(m.image_urls)) == (body_html, image_urls)
+    finally:
+        sess.close()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+web のリクエストスレッドとスケジューラが同時に書き込んでも
+"database is locked" にならないことの確認（db.py の SQLite 調整）。
+"""
+
+import threading
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import db
+import email_sync_app
+from email_sync_app import EmailModel
+
+WRITERS   = 8
+READERS   = 8
+UPDATERS  = 4
+PER_THREAD = 100
+
+
+def test_concurrent_writers_and_readers_do_not_lock(sqlite_file_db):
+    email_sync_app.init_db()
+    errors: list[Exception] = []
+    start = threading.Barrier(WRITERS + READERS + UPDATERS)
+
+    def run(fn):
+        start.wait()
+        for i in range(PER_THREAD):
+            sess = db.Session()
+            try:
+                fn(sess, i)
+            except OperationalError as e:
+                errors.append(e)
+                sess.rollback()
+            finally:
+                sess.close()
+
+    def writer(w):
+        def step(sess, i):
+            # _save_uids と同じく、重複確認してから insert + commit
+            mid = f'<{w}-{i}@test>'
+            if sess.query(EmailModel.uid).filter_by(message_id=mid).first() is None:
+                sess.add(EmailModel(uidvalidity=w, uid=i, message_id=mid,
+                                    subject='クリーニング見積もり', date=datetime.now()))
+                sess.commit()
+        return lambda: run(step)
+
+    def reader():
+        return lambda: run(lambda sess, i: sess.query(EmailModel).count())
+
+    def updater():
+        # update_status と同じく、読んでから書く
+        def step(sess, i):
+            m = sess.query(EmailModel).order_by(EmailModel.uid).first()
+            if m is not None:
+                m.status = f'更新{i}'
+                sess.commit()
+        return lambda: run(step)
+
+    targets = ([writer(w) for w in range(WRITERS)]
+               + [reader() for _ in range(READERS)]
+               + [updater() for _ in range(UPDATERS)])
+    threads = [threading.Thread(target=t) for t in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not [e for e in errors if 'database is locked' in str(e)]
+    assert not errors
+
+    sess = db.Session()
+    try:
+        assert sess.query(EmailModel).count() == WRITERS * PER_THREAD
+        assert sess.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+    finally:
+        sess.close()
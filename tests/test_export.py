@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""export: 見積もりデータの CSV 書き出し"""
+
+import csv
+import io
+
+import db
+import email_sync_app
+import export
+from conftest import add_email
+from email_sync_app import EmailModel
+
+
+def read_csv(rows) -> list[dict]:
+    text = ''.join(export.iter_csv(rows)).lstrip('\ufeff')
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def test_stale_field_keys_do_not_break_csv(sqlite_file_db):
+    email_sync_app.init_db()
+    sess = db.Session()
+    add_email(sess, 1, fields={'お名前': '佐藤', '廃止された項目': 'x'})
+    add_email(sess, 2)
+    sess.commit()
+
+    try:
+        out = read_csv(export.iter_db_rows(sess))
+    finally:
+        sess.close()
+
+    assert [r['お名前'] for r in out] == ['佐藤', '山田']
+    assert '廃止された項目' not in out[0]
+
+
+def test_archived_emails_are_exported(sqlite_file_db):
+    import archive
+
+    email_sync_app.init_db()
+    sess = db.Session()
+    for uid in range(1, 21):
+        add_email(sess, uid)
+    sess.get(EmailModel, (1, 1)).status = '荷物返送済み'
+    sess.commit()
+
+    try:
+        assert archive.archive_old(sess, days=0) == 1
+        out = read_csv(export.iter_db_rows(sess))
+        hot = read_csv(export.iter_db_rows(sess, include_archived=False))
+        done = read_csv(export.iter_db_rows(sess, statuses=['荷物返送済み']))
+    finally:
+        sess.close()
+
+    assert len(out) == 20
+    assert len(hot) == 19
+    assert [(r['uid'], r['お名前']) for r in done] == [('1', '山田')]
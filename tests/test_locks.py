@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""locks: プロセスをまたぐ排他と、スケジューラを 1 か所だけで起動すること"""
+
+import importlib.util
+import os
+from types import SimpleNamespace
+
+import app as app_module
+import email_sync_app
+import locks
+
+
+def test_lock_is_exclusive_until_released(sqlite_file_db):
+    email_sync_app.init_db()
+    token = locks.acquire('imap_sync')
+    assert token
+    assert locks.acquire('imap_sync') is None
+    assert locks.acquire('archive')                 # 名前が違えば別のロック
+    locks.release('imap_sync', token)
+    assert locks.acquire('imap_sync')
+
+
+def test_stale_lock_is_taken_over(sqlite_file_db, monkeypatch):
+    email_sync_app.init_db()
+    crashed = locks.acquire('imap_sync')
+    monkeypatch.setenv('LOCK_TTL', '-1')
+    token = locks.acquire('imap_sync')
+    assert token
+    monkeypatch.delenv('LOCK_TTL')
+    locks.release('imap_sync', crashed)             # 奪われた側が外しても残る
+    assert locks.acquire('imap_sync') is None
+    locks.release('imap_sync', token)
+
+
+def test_sync_skips_while_another_process_syncs(sqlite_file_db, monkeypatch):
+    email_sync_app.init_db()
+    calls = []
+    monkeypatch.setattr(app_module, 'fetch_and_save', lambda limit: calls.append(limit))
+
+    other = locks.acquire(app_module.SYNC_LOCK)     # 別プロセス（スケジューラなど）が同期中
+    assert app_module.sync_latest(limit=10) is False
+    locks.release(app_module.SYNC_LOCK, other)
+    assert app_module.sync_latest(limit=10) is True
+    assert calls == [10]
+
+
+def test_scheduler_starts_only_in_gunicorn_master(sqlite_file_db, monkeypatch):
+    started = []
+    monkeypatch.setattr(app_module, 'build_scheduler',
+                        lambda: SimpleNamespace(start=lambda: started.append(os.getpid())))
+    monkeypatch.setenv('RUN_SCHEDULER', '1')
+
+    app_module.create_app()                         # worker / CLI ごとには起動しない
+    assert started == []
+
+    path = os.path.join(os.path.dirname(app_module.__file__), 'gunicorn.conf.py')
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', path)
+    conf = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(conf)
+    conf.when_ready(SimpleNamespace(log=SimpleNamespace(info=lambda *a: None)))
+    assert started == [os.getpid()]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""render_body_html: 旧 fmtBody（emails.html）のサーバ側移植"""
+
+from email_sync_app import render_body_html
+
+
+def test_text_is_escaped():
+    out, urls = render_body_html('<script>alert("x")</script>\nit\'s')
+    assert out == '&lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt;<br>it&#x27;s'
+    assert urls == []
+
+
+def test_bracketed_images_become_thumbnails():
+    out, urls = render_body_html('写真 <https://ex.com/a.png> と [https://ex.com/b.JPG]')
+    assert urls == ['https://ex.com/a.png', 'https://ex.com/b.JPG']
+    assert '&lt;' not in out and '[' not in out         # 囲みの記号ごと置き換わる
+    assert out.count('<img class="inline-thumb" src="/proxy?url=https%3A%2F%2Fex.com%2Fa.png">') == 1
+    assert out.count('href="/proxy?url=https%3A%2F%2Fex.com%2Fb.JPG" download>DL</a>') == 1
+
+
+def test_proxy_url_is_percent_encoded():
+    out, urls = render_body_html('https://ex.com/写真/a&b.gif')
+    assert urls == ['https://ex.com/写真/a&b.gif']
+    assert 'src="/proxy?url=https%3A%2F%2Fex.com%2F%E5%86%99%E7%9C%9F%2Fa%26b.gif"' in out
+
+
+def test_links_are_linkified_but_images_are_not():
+    out, _ = render_body_html('https://ex.com/page?a=1&b=2\nhttps://ex.com/c.jpeg')
+    assert ('<a href="https://ex.com/page?a=1&amp;b=2" target="_blank">'
+            'https://ex.com/page?a=1&amp;b=2</a>') in out
+    assert out.count('<a ') == 2                        # ページへのリンク + 画像の DL だけ
+    assert 'href="https://ex.com/c.jpeg"' not in out
+
+
+def test_empty_body():
+    assert render_body_html('') == ('', [])
+    assert render_body_html(None) == ('', [])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""reparse: 保存済み raw_bytes / raw_content からの再解析"""
+
+import json
+
+import db
+import email_sync_app
+import reparse
+from conftest import add_email, make_raw
+from email_sync_app import EmailModel
+
+
+def bodies() -> dict[int, str]:
+    sess = db.Session()
+    try:
+        return dict(sess.query(EmailModel.uid, EmailModel.body))
+    finally:
+        sess.close()
+
+
+def run(tmp_path, monkeypatch, **kw):
+    monkeypatch.setattr(reparse, 'CHECKPOINT', str(tmp_path / 'checkpoint.json'))
+    reparse.run(workers=1, chunk_size=2, **kw)
+
+
+def test_unparseable_message_does_not_stop_the_run(sqlite_file_db, tmp_path, monkeypatch):
+    email_sync_app.init_db()
+    sess = db.Session()
+    for uid in range(1, 6):
+        charset = 'x-unknown' if uid == 3 else 'utf-8'
+        add_email(sess, uid, raw=make_raw(uid, '９. お名前 : 山田'.encode(), charset), body='old')
+    sess.commit()
+    sess.close()
+
+    run(tmp_path, monkeypatch)
+
+    got = bodies()
+    assert got[3] == 'old'
+    assert all(got[uid] == '９. お名前 : 山田' for uid in (1, 2, 4, 5))
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+def test_lossy_raw_content_is_left_alone(sqlite_file_db, tmp_path, monkeypatch):
+    email_sync_app.init_db()
+    sjis = 'お名前：山田太郎'.encode('shift_jis')
+    sess = db.Session()
+    # 1 は raw_content だけ（バイトが欠けている）、2 は raw_bytes あり
+    add_email(sess, 1, raw=make_raw(1, sjis, 'shift_jis'), with_bytes=False, body='old')
+    add_email(sess, 2, raw=make_raw(2, sjis, 'shift_jis'), body='old')
+    add_email(sess, 3, raw=make_raw(3, 'お名前：山田'.encode()), with_bytes=False, body='old')
+    # charset 指定が無い 8bit 本文も欠けている可能性がある
+    add_email(sess, 4, raw=make_raw(4, sjis).replace(b'; charset=utf-8', b''),
+              with_bytes=False, body='old')
+    # 7bit で送れる ISO-2022-JP は raw_content にそのまま残る
+    add_email(sess, 5, raw=make_raw(5, 'お名前：山田'.encode('iso-2022-jp'), 'iso-2022-jp', '7bit'),
+              with_bytes=False, body='old')
+    sess.commit()
+    sess.close()
+
+    run(tmp_path, monkeypatch)
+
+    assert bodies() == {1: 'old', 2: 'お名前：山田太郎', 3: 'お名前：山田', 4: 'old',
+                        5: 'お名前：山田'}
+
+
+def test_archived_emails_are_reparsed(sqlite_file_db, tmp_path, monkeypatch):
+    import archive
+
+    email_sync_app.init_db()
+    sjis = 'お名前：山田太郎'.encode('shift_jis')
+    sess = db.Session()
+    add_email(sess, 1, raw=make_raw(1, '９. お名前 : 佐藤'.encode()), body='old',
+              fields={'お名前': '古い解析'}, status='荷物返送済み')
+    add_email(sess, 2, raw=make_raw(2, sjis, 'shift_jis'), with_bytes=False, body='old',
+              status='荷物返送済み')
+    add_email(sess, 3, raw=make_raw(3, '９. お名前 : 鈴木'.encode()), body='old')
+    sess.commit()
+    assert archive.archive_old(sess, days=0) == 2
+    sess.close()
+
+    # emails は済んでいて、アーカイブの途中から再開する
+    (tmp_path / 'checkpoint.json').write_text('{"table": "emails_archive", "after": [0, 0], "done": 1}')
+    run(tmp_path, monkeypatch)
+
+    sess = db.Session()
+    try:
+        data = {a.uid: archive.unpack_payload(a.payload)
+                for a in sess.query(archive.ArchivedEmailModel)}
+    finally:
+        sess.close()
+    assert data[1]['body'] == '９. お名前 : 佐藤'
+    assert json.loads(data[1]['fields'])['お名前'] == '佐藤'
+    assert data[1]['customer_name'] == '佐藤'
+    assert data[2]['body'] == 'old'                 # 欠けた raw_content しか無いので触らない
+    assert bodies() == {3: 'old'}                   # emails はチェックポイントより前
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""_save_uids: 1 通の失敗で同期全体が止まらないこと"""
+
+import db
+import email_sync_app
+from conftest import make_raw
+from email_sync_app import EmailModel
+
+
+class FakeImap:
+    def __init__(self, messages: dict[int, bytes]):
+        self.messages = messages
+
+    def uid(self, command, uid, what):
+        return 'OK', [(b'', self.messages[int(uid)])]
+
+
+def test_undecodable_message_is_skipped(sqlite_file_db):
+    email_sync_app.init_db()
+    imap = FakeImap({1: make_raw(1, charset='x-unknown'), 2: make_raw(2)})
+
+    email_sync_app._save_uids(imap, 1, [1, 2])
+
+    sess = db.Session()
+    try:
+        assert [uid for (uid,) in sess.query(EmailModel.uid)] == [2]
+    finally:
+        sess.close()
+
+
+def test_archived_message_is_not_ingested_again(sqlite_file_db):
+    import archive
+    import status_counts
+
+    email_sync_app.init_db()
+    imap = FakeImap({1: make_raw(1)})
+    email_sync_app._save_uids(imap, 1, [1])
+
+    sess = db.Session()
+    try:
+        sess.get(EmailModel, (1, 1)).status = '荷物返送済み'
+        sess.commit()
+        status_counts.reconcile(sess)
+        assert archive.archive_old(sess, days=0) == 1
+
+        email_sync_app._save_uids(imap, 1, [1])     # 同じ UID 範囲を再スキャン
+
+        assert sess.query(EmailModel).count() == 0
+        assert sess.query(archive.ArchivedEmailModel).count() == 1
+        assert status_counts.totals(sess) == {'荷物返送済み': 1}
+        assert archive.load(sess, 1, 1).raw_bytes == make_raw(1)      # 元のバイト列のまま残る
+    finally:
+        sess.close()
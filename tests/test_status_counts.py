@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""status_counts: bump が同時に数えても取りこぼさない形（upsert）であること・累計の読み出し"""
+
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql, sqlite
+
+import db
+import email_sync_app
+import status_counts
+from conftest import add_email
+
+DAY = date(2024, 1, 1)
+
+
+def test_bump_upserts_and_decrements(sqlite_file_db):
+    email_sync_app.init_db()
+    for delta in (1, 1, -1):
+        sess = db.Session()
+        status_counts.bump(sess, '依頼あり', DAY, delta)
+        sess.commit()
+        sess.close()
+
+    sess = db.Session()
+    try:
+        assert status_counts.totals(sess) == {'依頼あり': 1}
+    finally:
+        sess.close()
+
+
+def test_totals_read_only_the_running_totals(sqlite_file_db):
+    email_sync_app.init_db()
+    sess = db.Session()
+    try:
+        status_counts.bump(sess, '依頼あり', DAY)
+        status_counts.bump(sess, '依頼あり', date(2024, 1, 2))
+        status_counts.bump(sess, '未対応', DAY)
+        status_counts.bump(sess, '未対応', DAY, -1)
+        sess.commit()
+        assert status_counts.totals(sess) == {'依頼あり': 2}
+
+        sess.query(status_counts.StatusCountModel).delete()     # 日別の行は読まない
+        sess.commit()
+        assert status_counts.totals(sess) == {'依頼あり': 2}
+    finally:
+        sess.close()
+
+
+def test_reconcile_rebuilds_totals(sqlite_file_db):
+    email_sync_app.init_db()
+    sess = db.Session()
+    try:
+        add_email(sess, 1, status='依頼あり')
+        add_email(sess, 2, status='依頼あり', date=None)
+        add_email(sess, 3, status=None)
+        sess.commit()
+        status_counts.bump(sess, '依頼あり', DAY, 5)            # ずれたカウンタ
+        sess.commit()
+
+        status_counts.reconcile(sess)
+        assert status_counts.totals(sess) == {'依頼あり': 2, '新規': 1}
+    finally:
+        sess.close()
+
+
+class RecordingSession:
+    """bump が実行する文を方言ごとに SQL 文字列にして記録するだけのセッション"""
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.sql: list[str] = []
+
+    def get_bind(self):
+        return SimpleNamespace(dialect=self.dialect)
+
+    def execute(self, stmt):
+        self.sql.append(str(stmt.compile(dialect=self.dialect)))
+
+    def add(self, obj):
+        raise AssertionError('UPDATE → INSERT の 2 段になっている')
+
+
+# SQLite は書き込みを直列化するので、同時実行のテストでは主キー重複を再現できない。
+# 代わりに、どちらの方言でも 1 文の ON CONFLICT upsert になっていることを確かめる
+@pytest.mark.parametrize('dialect', [sqlite.dialect(), postgresql.dialect()], ids=['sqlite', 'postgresql'])
+def test_bump_is_a_single_upsert_per_table(dialect):
+    sess = RecordingSession(dialect)
+    status_counts.bump(sess, '新規', DAY)
+
+    assert len(sess.sql) == 2
+    counts, totals = sess.sql
+    assert counts.startswith('INSERT INTO status_counts ')
+    assert counts.endswith('ON CONFLICT (status, day) DO UPDATE '
+                           'SET count = (status_counts.count + excluded.count)')
+    assert totals.startswith('INSERT INTO status_totals ')
+    assert totals.endswith('ON CONFLICT (status) DO UPDATE '
+                           'SET count = (status_totals.count + excluded.count)')
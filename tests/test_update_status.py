@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""/emails/<uv>/<uid>/update_status: ステータス変更とカウンタ・アーカイブの整合"""
+
+import pytest
+
+import archive
+import db
+import email_sync_app
+import status_counts
+from app import create_app
+from conftest import add_email, make_raw
+from email_sync_app import EmailModel
+
+
+@pytest.fixture
+def client(sqlite_file_db, monkeypatch):
+    monkeypatch.delenv('RUN_SCHEDULER', raising=False)
+    email_sync_app.init_db()
+    return create_app().test_client()
+
+
+def post_status(client, uid: int, status: str):
+    return client.post(f'/emails/1/{uid}/update_status', data={'status': status})
+
+
+def test_archived_email_comes_back_when_reopened(client):
+    raw  = make_raw(1)
+    sess = db.Session()
+    add_email(sess, 1, raw=raw, status='荷物返送済み')
+    sess.commit()
+    status_counts.reconcile(sess)
+    assert archive.archive_old(sess, days=0) == 1
+    sess.close()
+
+    assert post_status(client, 1, '荷物返送済み').status_code == 200     # 変わらないだけ
+    assert post_status(client, 1, '依頼あり').status_code == 200
+
+    sess = db.Session()
+    try:
+        m = sess.get(EmailModel, (1, 1))
+        assert m.status == '依頼あり'
+        assert m.raw_bytes == raw
+        assert sess.query(archive.ArchivedEmailModel).count() == 0
+        assert status_counts.totals(sess) == {'依頼あり': 1}
+    finally:
+        sess.close()
+
+
+def test_archived_email_cannot_move_between_archive_statuses(client, monkeypatch):
+    monkeypatch.setenv('ARCHIVE_STATUSES', '荷物返送済み,未対応')
+    sess = db.Session()
+    add_email(sess, 1, status='荷物返送済み')
+    sess.commit()
+    assert archive.archive_old(sess, days=0) == 1
+    sess.close()
+
+    assert post_status(client, 1, '未対応').status_code == 409
+
+    sess = db.Session()
+    try:
+        assert sess.get(archive.ArchivedEmailModel, (1, 1)).status == '荷物返送済み'
+    finally:
+        sess.close()
+
+
+def test_unknown_status_is_rejected(client):
+    sess = db.Session()
+    add_email(sess, 1)
+    sess.commit()
+    sess.close()
+
+    assert post_status(client, 1, '適当な文字列').status_code == 400
+
+
+def test_concurrent_change_does_not_skew_counts(client, monkeypatch):
+    import app as app_module
+
+    sess = db.Session()
+    add_email(sess, 1, status='依頼あり')
+    sess.commit()
+    status_counts.reconcile(sess)
+    sess.close()
+
+    def racing_session():
+        """読んだ直後に別のリクエストが同じメールのステータスを変えて commit する"""
+        sess = db.Session()
+        get = sess.get
+
+        def get_then_race(model, key):
+            m = get(model, key)
+            if model is EmailModel:
+                other = db.Session()
+                o = other.get(EmailModel, key)
+                o.status = '荷物受け取り'
+                status_counts.bump(other, '依頼あり', status_counts.day_of(o), -1)
+                status_counts.bump(other, '荷物受け取り', status_counts.day_of(o), +1)
+                other.commit()
+                other.close()
+            return m
+
+        sess.get = get_then_race
+        return sess
+
+    monkeypatch.setattr(app_module, 'Session', racing_session)
+    assert post_status(client, 1, '荷物返送済み').status_code == 409
+
+    sess = db.Session()
+    try:
+        assert sess.get(EmailModel, (1, 1)).status == '荷物受け取り'
+        assert status_counts.totals(sess) == {'荷物受け取り': 1}
+    finally:
+        sess.close()